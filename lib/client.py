@@ -2,27 +2,58 @@
 # This is distributed under cc0. See the LICENCE file distributed along with
 # this code.
 
+import bisect
 import random
 
+from collections import OrderedDict, deque
 from math import floor
 
 from py3hax import *
 import simtime
+import stats
+import tor
 
 class GivingUp(Exception):
     pass
 
 class ExponentialTimer(object):
     """ Implements an exponential timer using simulated time. """
-    def __init__(self, initial, multiplier):
+
+    __slots__ = ('_initial_delay', '_multiplier', '_shift', '_jitter',
+                 '_next', '_cur_delay')
+
+    def __init__(self, initial, multiplier, jitter=False):
         """Create a timer that's ready to fire immediately.  After
            it first fires, it won't be ready again until 'initial'
            seconds have passed.  Each time after that, it will
            increase the delay by a factor of 'multiplier'.
+
+           If 'jitter' is true, each delay is scaled by a random factor
+           in [0.5, 1.5) so that many clients created together don't
+           all retry in lockstep.
         """
+        self._jitter = jitter
+        # Simulated time is integer seconds, so keep the delay math on
+        # ints whenever the caller passes integral values (the defaults
+        # do): integer compares in isReady() are cheaper than float
+        # ones, and repeated multiplication can't drift.
+        if initial == int(initial):
+            initial = int(initial)
+        if multiplier == int(multiplier):
+            multiplier = int(multiplier)
         self._initial_delay = initial
         self._multiplier = multiplier
 
+        # With an all-integer delay and a power-of-two multiplier (the
+        # default RETRY_MULT is 2), fire() can grow the delay with a
+        # single shift instead of a multiply.
+        if (isinstance(initial, int) and isinstance(multiplier, int)
+                and multiplier > 0
+                and multiplier & (multiplier - 1) == 0):
+            self._shift = multiplier.bit_length() - 1
+        else:
+            self._shift = None
+
         self.reset()
 
     def reset(self):
@@ -30,15 +61,26 @@ class ExponentialTimer(object):
         self._next = 0
         self._cur_delay = self._initial_delay
 
-    def isReady(self):
-        """Return true iff the timer is ready to fire now."""
-        return self._next <= simtime.now()
+    def isReady(self, now=None):
+        """Return true iff the timer is ready to fire now.  Callers that
+           already know the time can pass it as 'now' to save the
+           clock read."""
+        if now is None:
+            now = simtime.now()
+        return self._next <= now
 
-    def fire(self):
+    def fire(self, now=None):
         """Fire the timer."""
-        assert self.isReady()
-        self._next = simtime.now() + self._cur_delay
-        self._cur_delay *= self._multiplier
+        if now is None:
+            now = simtime.now()
+        delay = self._cur_delay
+        if self._jitter:
+            delay = max(1, int(delay * random.uniform(0.5, 1.5)))
+        self._next = now + delay
+        if self._shift is not None:
+            self._cur_delay <<= self._shift
+        else:
+            self._cur_delay *= self._multiplier
 
 
 class ClientParams(object):
@@ -51,6 +93,11 @@ class ClientParams(object):
     # percentage of guards to keep in a guard list (dystopic)
     DYSTOPIC_GUARDS_THRESHOLD = 0.05
 
+    # These are read on every circuit attempt; slots keep the lookups
+    # out of a per-instance dict.
+    __slots__ = ('TOO_MANY_GUARDS', 'TOO_RECENTLY',
+                 'RETRY_DELAY', 'RETRY_MULT')
+
     def __init__(self,
                  TOO_MANY_GUARDS=100, # XXX too high
                  TOO_RECENTLY=86400,
@@ -72,6 +119,12 @@ class Guard(object):
     """
        Represents what a client knows about a guard.
     """
+    # A long simulation accumulates a lot of these, and getGuard()
+    # walks them constantly; slots halve the footprint and speed up
+    # the attribute reads.
+    __slots__ = ('_node', '_markedDown', '_markedUp', '_tried',
+                 '_addedAt', '_listed', '_canTry')
+
     def __init__(self, node):
         # tornet.Node instance
         self._node = node
@@ -91,6 +144,13 @@ class Guard(object):
         # True iff the node is listed as a guard in the most recent consensus
         self._listed = True
 
+        # Cached value of canTry(), kept in sync by the mark* methods
+        # so the hot filters in getGuard() only read one attribute.
+        self._canTry = True
+
+    def _recomputeCanTry(self):
+        self._canTry = self._listed and not (self._tried and self._markedDown)
+
     def getNode(self):
         """Return the underlying torsim.Node object for this guard."""
         return self._node
@@ -105,20 +165,23 @@ class Guard(object):
         else:
             self._markedDown = True
             self._markedUp = False
+        self._recomputeCanTry()
 
     def markUnlisted(self):
         """Mark this guard as unlisted because it didn't appear in the
            most recent consensus."""
         self._listed = False
+        self._recomputeCanTry()
 
     def markListed(self):
         """Mark this guard as listed because it did appear in the
            most recent consensus."""
         self._listed = True
+        self._recomputeCanTry()
 
     def canTry(self):
         """Return true iff we can try to make a connection to this guard."""
-        return self._listed and not (self._tried and self._markedDown)
+        return self._canTry
 
     def isListed(self):
         """Return true iff the guard is listed in the most recent consensus
@@ -132,11 +195,16 @@ class Guard(object):
         # XXXX down.  But maybe we should give early guards in a list
         # XXXX a chance again after a while?
         self._tried = False
+        self._recomputeCanTry()
 
-    def addedWithin(self, nSec):
+    def addedWithin(self, nSec, now=None):
         """Return true iff this guard was added within the last 'nSec'
-           simulated seconds."""
-        return self._addedAt + nSec >= simtime.now()
+           simulated seconds.  Callers scanning many guards should pass
+           the time as 'now' rather than paying a clock read per
+           guard."""
+        if now is None:
+            now = simtime.now()
+        return self._addedAt + nSec >= now
 
 class Client(object):
     """
@@ -154,13 +222,30 @@ class Client(object):
         # utopic sets.  each guard is represented here as a torsim.Node.
         self._DYSTOPIC_GUARDS = self._UTOPIC_GUARDS = None
 
-        # lists of Guard objects for the dystopic and utopic guards
-        # configured on this client.
-        self._PRIMARY_DYS = []
-        self._PRIMARY_U = []
+        # ordered maps from node ID to Guard object for the dystopic
+        # and utopic guards configured on this client.  Insertion order
+        # is preserved (it's the order we chose the guards in), and
+        # membership tests by node ID are O(1).
+        self._PRIMARY_DYS = OrderedDict()
+        self._PRIMARY_U = OrderedDict()
+
+        # timestamps of recent guard additions, oldest first, one deque
+        # per dystopia setting.  addGuard() expires entries from the
+        # front, so the too-many-too-recently check is a length test
+        # instead of a scan of the whole guard list.
+        self._recentDys = deque()
+        self._recentU = deque()
 
         self._retryTimer = ExponentialTimer(parameters.RETRY_DELAY,
-                                            parameters.RETRY_MULT)
+                                            parameters.RETRY_MULT,
+                                            jitter=True)
+
+        # tracks the guards we've been exposed to.
+        self._stats = stats.Stats()
+
+        # this client's own PRNG: skips the module-level indirection on
+        # every draw, and a per-client seed makes runs reproducible.
+        self._rng = random.Random()
 
         # XXXX document
         self._maybeDystopic = False
@@ -170,42 +255,96 @@ class Client(object):
     def nodeSeemsDystopic(self,node):
         """Return true iff this node seems like one we could use in a
            dystopic world."""
-        return node.getPort() in [80, 443]
+        return node.seemsDystopic()
 
     def updateGuardLists(self):
         """Called at start and when a new consensus should be made & received:
            updates *TOPIC_GUARDS."""
-        self._DYSTOPIC_GUARDS = []
-        self._UTOPIC_GUARDS = []
-
         # XXXX I'm not sure what happens if a node changes its ORPort
         # XXXX or when the client changes its policies.
 
         # Temporary set of node IDs for the listed nodes.
         liveIDs = set()
 
+        # This loop visits every node in the consensus, so bind the
+        # loop body's lookups to locals once up front.
+        dystopicGuards = []
+        utopicGuards = []
+        dysApp = dystopicGuards.append
+        utoApp = utopicGuards.append
+        liveAdd = liveIDs.add
+
         # We get the latest consensus here.
         for node in self._net.new_consensus():
-            liveIDs.add(node.getID())
-            if self.nodeSeemsDystopic(node):
-                self._DYSTOPIC_GUARDS.append(node)
+            liveAdd(node.getID())
+            if node.seemsDystopic():
+                dysApp(node)
             else:
                 # XXXX Having this be 'else' means that FirewallPorts
                 # XXXX has affect even when FascistFirewall is disabled.
                 # XXXX Interesting!  And maybe bad!
-                self._UTOPIC_GUARDS.append(node)
-
-        # Now mark every Guard we have as listed or unlisted.
+                utoApp(node)
+
+        self._DYSTOPIC_GUARDS = dystopicGuards
+        self._UTOPIC_GUARDS = utopicGuards
+
+        # The consensus only changes when this function runs, so cache
+        # its size here rather than re-fetching the whole consensus
+        # every time getNPrimary() runs (once per circuit attempt).
+        # Both threshold inputs are fixed until the next consensus, so
+        # precompute the allowed primary-list sizes too.
+        self._nConsensus = len(liveIDs)
+        self._nPrimaryDys = int(floor(
+            self._nConsensus * self._p.DYSTOPIC_GUARDS_THRESHOLD))
+        self._nPrimaryU = int(floor(
+            self._nConsensus * self._p.UTOPIC_GUARDS_THRESHOLD))
+
+        # Now mark every Guard whose listed status changed.  Most
+        # guards keep their status across consecutive consensuses, so
+        # skip the redundant mark calls (and the canTry recomputation
+        # they trigger) for the ones that didn't move.
         for lst in (self._PRIMARY_DYS, self._PRIMARY_U):
-            for g in lst:
-                if g.getNode().getID() in liveIDs:
-                    g.markListed()
-                else:
-                    g.markUnlisted()
-
+            for g in lst.values():
+                listed = g.getNode().getID() in liveIDs
+                if listed != g.isListed():
+                    if listed:
+                        g.markListed()
+                    else:
+                        g.markUnlisted()
+
+        # Consensus nodes that weren't guards of ours when this
+        # consensus arrived, plus their cumulative bandwidth weights.
+        # Built once per consensus; _chooseNewGuardNode() samples the
+        # weights with a binary search and skips the few nodes we've
+        # picked since, so selection doesn't re-derive anything per
+        # attempt.
+        self._unusedDys = [ n for n in self._DYSTOPIC_GUARDS
+                            if n.getID() not in self._PRIMARY_DYS ]
+        self._unusedU = [ n for n in self._UTOPIC_GUARDS
+                          if n.getID() not in self._PRIMARY_U ]
+        self._cumWeightsDys = self._buildCumWeights(self._unusedDys)
+        self._cumWeightsU = self._buildCumWeights(self._unusedU)
+
+        self._updateCanAdd()
+
+    @staticmethod
+    def _buildCumWeights(nodes):
+        """Return the cumulative bandwidth weights for 'nodes'."""
+        return list(accumulate(n.getBandwidth() for n in nodes))
+
+    def _updateCanAdd(self):
+        """Recompute whether each primary guard list still has room for
+           another guard.  The inputs only change when a guard is added
+           or a new consensus arrives, so getGuard() can read the cached
+           flags instead of recounting the lists on every circuit."""
+        nListedDys = sum(1 for g in self._PRIMARY_DYS.values() if g.isListed())
+        nListedU = sum(1 for g in self._PRIMARY_U.values() if g.isListed())
+        self._canAddDys = nListedDys < self.getNPrimary(True)
+        self._canAddU = nListedU < self.getNPrimary(False)
 
     def getPrimaryList(self, dystopic):
-        """Get the list of primary Guards for a given dystopia setting """
+        """Get the ordered node-ID-to-Guard map of primary guards for a
+           given dystopia setting """
         if dystopic:
             return self._PRIMARY_DYS
         else:
@@ -219,16 +358,48 @@ class Client(object):
         else:
             return self._UTOPIC_GUARDS
 
+    def getUnusedList(self, dystopic):
+        """Get the list of consensus Nodes that weren't guards of ours
+           as of the last consensus, for a given dystopia setting"""
+        if dystopic:
+            return self._unusedDys
+        else:
+            return self._unusedU
+
+    def _chooseNewGuardNode(self, dystopic):
+        """Pick a node from the consensus to become a new guard,
+           weighted by bandwidth.  Return None if no node is left.
+
+           Normally this is a single random draw plus a binary search
+           of the per-consensus cumulative weights; the few nodes we
+           picked since the last consensus are still in the candidate
+           list, so redraw when we happen to hit one of them.
+        """
+        lst = self.getPrimaryList(dystopic)
+        candidates = self.getUnusedList(dystopic)
+        cum = self._cumWeightsDys if dystopic else self._cumWeightsU
+
+        if cum and cum[-1] > 0:
+            uniform = self._rng.uniform
+            for _ in xrange(8):
+                target = uniform(0, cum[-1])
+                node = candidates[bisect.bisect_left(cum, target)]
+                if node.getID() not in lst:
+                    return node
+
+        # Everything we drew was already a guard (or the weights were
+        # degenerate); filter exactly and do one weighted pick.
+        remaining = [ n for n in candidates if n.getID() not in lst ]
+        if len(remaining) == 0:
+            return None
+        return tor.choose_node_by_bandwidth_weights(remaining)
+
     def getNPrimary(self, dystopic):
         """Return the number of listed primary guards that we'll allow."""
-        total_running_guards = len(self._net.new_consensus())
-
         if dystopic:
-            r = floor(total_running_guards * self._p.DYSTOPIC_GUARDS_THRESHOLD)
+            return self._nPrimaryDys
         else:
-            r = floor(total_running_guards * self._p.UTOPIC_GUARDS_THRESHOLD)
-
-        return r
+            return self._nPrimaryU
 
     def addGuard(self, node, dystopic=False):
         """Try to add a single Node 'node' to the 'dystopic' guard list."""
@@ -237,16 +408,22 @@ class Client(object):
         # prop241: if we have added too many guards too recently, die!
         # XXXX Is this what prop241 actually says?
 
-        nRecent = 1 # this guard will be recent.
-        for g in lst:
-            if g.addedWithin(self._p.TOO_RECENTLY):
-                nRecent += 1
+        recent = self._recentDys if dystopic else self._recentU
+        now = simtime.now()
+        cutoff = now - self._p.TOO_RECENTLY
+        while recent and recent[0] < cutoff:
+            recent.popleft()
 
-        if nRecent >= self._p.TOO_MANY_GUARDS:
+        # this guard will be recent too.
+        if len(recent) + 1 >= self._p.TOO_MANY_GUARDS:
             raise GivingUp("Too many guards added too recently!")
+        recent.append(now)
 
-        # now actually add the guard.
-        lst.append(Guard(node))
+        # now actually add the guard.  The candidate list keeps its
+        # entry for 'node'; selection rejects nodes that are already
+        # guards, so no O(n) removal is needed here.
+        lst[node.getID()] = Guard(node)
+        self._updateCanAdd()
 
     def inADystopia(self):
         return False # Dystopia detection not implemented XXXXX
@@ -257,10 +434,7 @@ class Client(object):
     def nodeIsInGuardList(self, n, gl):
         """Return true iff there is a Guard in 'gl' corresponding to the Node
            'n'."""
-        for g in gl:
-            if g.getNode() == n:
-                return True
-        return False
+        return n.getID() in gl
 
     def getGuard(self, dystopic):
         """We're about to build a circuit: return a guard to try."""
@@ -272,46 +446,56 @@ class Client(object):
         # XXXX when we think we're not in a dystopia?
         lst = self.getPrimaryList(dystopic)
 
-        usable = [ g for g in lst if g.canTry() ]
-        listed = [ g for g in lst if g.isListed() ]
+        # A single short-circuiting pass: the only thing we ever take
+        # from the usable set is its first element, so stop there
+        # instead of materializing the whole list.
+        usable = next((g for g in lst.values() if g.canTry()), None)
+        if usable is not None:
+            # Just use the first one that isn't down.
+            return usable
 
-        # See if we should retry or add more or use what we have.
-        # Here we consider the number of currently-guardy guards.
+        if dystopic:
+            canAdd = self._canAddDys
+        else:
+            canAdd = self._canAddU
 
-        if len(usable) == 0 and len(listed) >= self.getNPrimary(dystopic):
+        if not canAdd:
             # We can't add any more and we don't have any to try.
 
             # XXXX should this be two separate timers, one for each list?
-            if self._retryTimer.isReady():
-                self._retryTimer.fire()
-                for g in lst:
+            now = simtime.now()
+            if self._retryTimer.isReady(now):
+                self._retryTimer.fire(now)
+                # Mark and pick in the same pass: after markForRetry a
+                # guard is triable iff it's still listed, so there's no
+                # need to rescan the list afterwards.
+                first = None
+                for g in lst.values():
                     g.markForRetry()
+                    if first is None and g._listed:
+                        first = g
+                return first
 
-            usable = [ g for g in lst if g.canTry() ]
-
-            if not len(usable):
-                return None
-
-        if len(usable):
-            # Just use the first one that isn't down.
-            assert usable[0] != None
-            return usable[0]
+            # We only want the first guard that's willing to be tried;
+            # stop at the first hit instead of building a whole list.
+            return next((g for g in lst.values() if g.canTry()), None)
 
         # We can add another one.
-        full = self.getFullList(dystopic)
-        possible = [ n for n in full if not self.nodeIsInGuardList(n, lst) ]
-        if len(possible) == 0:
+        newnode = self._chooseNewGuardNode(dystopic)
+        if newnode is None:
             return None
-        newnode = random.choice(possible)
         self.addGuard(newnode, dystopic)
-        newguard = lst[-1]
-        assert newguard.getNode() == newnode
 
-        return newguard
+        return lst[newnode.getID()]
+
+    def getStats(self):
+        """Return the Stats object tracking this client's guard exposure."""
+        return self._stats
 
     def connectToGuard(self, guard):
         """Try to connect to 'guard' -- if it's up on the network, mark it up.
            Return true on success, false on failure."""
+        self._stats.addExposedTo(guard, simtime.now())
         up = self._net.probe_node_is_up(guard.getNode())
         guard.mark(up)
         return up
@@ -23,31 +23,41 @@ def trivialSimulation():
     ok = 0
     bad = 0
 
+    # Bind the hot callables to locals once; the innermost loop body
+    # runs 5400 times and would otherwise redo the attribute lookups
+    # on every iteration.
+    buildCircuit = c.buildCircuit
+    advanceTime = simtime.advanceTime
+    do_churn = net.do_churn
+    updateRunning = net.updateRunning
+
     for period in xrange(30): # one hour each
         for subperiod in xrange(30): # two minutes each
             if (subperiod % 10) == 0:
                 # nodes left and arrived
-                net.do_churn()
+                do_churn()
             # nodes went up and down
-            net.updateRunning()
+            updateRunning()
 
             for attempts in xrange(6): # 20 sec each
 
                 # actually have the client act.
-                if c.buildCircuit():
+                if buildCircuit():
                     ok += 1
                 else:
                     bad += 1
 
                 # time passed
-                simtime.advanceTime(20)
+                advanceTime(20)
 
         # new consensus
         c.updateGuardLists()
 
     print("Successful client circuits (total): %d (%d)" % (ok, (ok + bad)))
     print("Percentage of successful circuilts: %f%%"
-          % ((ok / float(ok + bad)) * 100.0))
+          % ((ok * 100.0) / (ok + bad)))
+    print("Number of guards exposed to: %d"
+          % c.getStats().guardsExposure())
 
 if __name__ == '__main__':
     trivialSimulation()
@@ -6,3 +6,12 @@ try:
     xrange
 except:
     xrange = range
+
+try:
+    from itertools import accumulate
+except ImportError:
+    def accumulate(iterable):
+        total = 0
+        for x in iterable:
+            total += x
+            yield total
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""Track statistics about a simulated client's behavior."""
+
+import array
+import bisect
+
+
+class Stats(object):
+    """
+       Tracks which guards a client has been exposed to over simulated
+       time.  "Exposed to" means we attempted a connection: every guard
+       we ever try is one more relay in a position to observe us.
+    """
+    def __init__(self):
+        # Every guard we've tried to connect to, in the order we first
+        # tried it.
+        self._EXPOSED_TO_GUARDS = []
+
+        # Set mirror of the list above, so the membership test we do on
+        # every probe is O(1) instead of a scan of the whole history.
+        self._EXPOSED_TO_GUARDS_SET = set()
+
+        # Parallel arrays recording, for each instant we probed at, how
+        # many guards we had been exposed to by then.  Simulated time
+        # only moves forward, so the ticks are already sorted and
+        # queries can binary-search instead of re-sorting a dict's keys.
+        # Flat unsigned arrays: one machine word per sample instead of
+        # a boxed Python int.
+        self._EXPOSURE_TICKS = array.array('L')
+        self._EXPOSURE_VALUES = array.array('L')
+
+    def addExposedTo(self, guard, when):
+        """Note that we attempted a connection to 'guard' at time 'when'."""
+        if guard not in self._EXPOSED_TO_GUARDS_SET:
+            self._EXPOSED_TO_GUARDS_SET.add(guard)
+            self._EXPOSED_TO_GUARDS.append(guard)
+        if self._EXPOSURE_TICKS and self._EXPOSURE_TICKS[-1] == when:
+            self._EXPOSURE_VALUES[-1] = len(self._EXPOSED_TO_GUARDS)
+        else:
+            self._EXPOSURE_TICKS.append(when)
+            self._EXPOSURE_VALUES.append(len(self._EXPOSED_TO_GUARDS))
+
+    def guardsExposure(self):
+        """Return how many distinct guards we've been exposed to so far."""
+        return len(self._EXPOSED_TO_GUARDS)
+
+    def guardsExposureAfter(self, time):
+        """Return how many distinct guards we had been exposed to at the
+           first recorded instant at or after 'time'."""
+        if not self._EXPOSURE_TICKS:
+            return 0
+        i = bisect.bisect_left(self._EXPOSURE_TICKS, time)
+        if i == len(self._EXPOSURE_TICKS):
+            i -= 1
+        return self._EXPOSURE_VALUES[i]
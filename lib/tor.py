@@ -0,0 +1,47 @@
+#!/usr/bin/python
+# This is distributed under cc0. See the LICENCE file distributed along with
+# this code.
+
+"""
+   The bits of tor's node-selection behavior that the client algorithm
+   needs: picking a random node weighted by bandwidth, roughly the way
+   tor's router_choose_random_node() does.
+"""
+
+import bisect
+import random
+
+from py3hax import *
+
+def compute_weighted_bandwidths(nodes):
+    """Return a list with the selection weight for each node in 'nodes'.
+       We just use the advertised bandwidth; the consensus weight
+       fractions don't matter for this simulation."""
+    return [ node.getBandwidth() for node in nodes ]
+
+def choose_array_element_by_weight(weights):
+    """Return the index of a random element of 'weights', chosen with
+       probability proportional to its weight.  Return -1 if 'weights'
+       is empty; choose uniformly if all the weights are zero."""
+    if len(weights) == 0:
+        return -1
+
+    cum = list(accumulate(weights))
+    total = cum[-1]
+    if total <= 0:
+        return random.randint(0, len(weights) - 1)
+
+    target = random.uniform(0, total)
+    i = bisect.bisect_left(cum, target)
+    if i == len(weights):
+        # Only reachable through floating-point rounding.
+        i -= 1
+    return i
+
+def choose_node_by_bandwidth_weights(nodes):
+    """Return a random node from 'nodes', weighted by bandwidth, or
+       None if 'nodes' is empty."""
+    i = choose_array_element_by_weight(compute_weighted_bandwidths(nodes))
+    if i < 0:
+        return None
+    return nodes[i]
@@ -11,8 +11,15 @@
 import random
 from py3hax import *
 
+# The ports that stay reachable in a dystopic world (i.e., that
+# fascist firewalls let through).  A tuple for random.choice and a
+# frozenset for membership tests, built once instead of per call.
+DYSTOPIC_PORTS = (80, 443)
+_DYSTOPIC_PORT_SET = frozenset(DYSTOPIC_PORTS)
+
 class Node(object):
-    def __init__(self, name, port, evil=False, reliability=0.96):
+    def __init__(self, name, port, evil=False, reliability=0.96,
+                 bandwidth=None):
         """Create a new Tor node."""
 
         # name for this node.
@@ -22,6 +29,17 @@ class Node(object):
         assert 1 <= port <= 65535
         self._port = port
 
+        # How much bandwidth does this node advertise?  Clients weight
+        # their guard choices by this.
+        if bandwidth is None:
+            bandwidth = _randbw()
+        self._bandwidth = bandwidth
+
+        # Could a client behind a port-filtering firewall plausibly
+        # reach this node?  The port never changes, so classify once
+        # here instead of per consensus on the client side.
+        self._seemsDystopic = port in _DYSTOPIC_PORT_SET
+
         # Is this a hostile node?
         self._evil = evil
 
@@ -70,6 +88,14 @@ class Node(object):
         """Return this node's ORPort"""
         return self._port
 
+    def getBandwidth(self):
+        """Return this node's advertised bandwidth"""
+        return self._bandwidth
+
+    def seemsDystopic(self):
+        """Return true iff this node looks usable in a dystopic world."""
+        return self._seemsDystopic
+
     def isReallyUp(self):
         """Return true iff this node is truly alive.  Client simulation code
            mustn't call this."""
@@ -80,12 +106,18 @@ class Node(object):
            mustn't call this."""
         return self._evil
 
+def _randbw():
+    """generate and return a random bandwidth, distributed roughly the
+       way real relay bandwidths are: a few fast relays and a long tail
+       of slow ones."""
+    return int(random.paretovariate(2.0) * 1000)
+
 def _randport(pfascistfriendly):
     """generate and return a random port.  If 'pfascistfriendly' is true,
        return a port in the FascistPortList.  Otherwise return any random
        TCP  port."""
     if random.random() < pfascistfriendly:
-        return random.choice([80, 443])
+        return random.choice(DYSTOPIC_PORTS)
     else:
         return random.randint(1,65535)
 
@@ -111,7 +143,8 @@ class Network(object):
         self._pfascistfriendly = pfascistfriendly
         self._pevil = pevil
 
-        # a list of all the Nodes on the network, dead and alive.
+        # a list of all the Nodes on the network.  Nodes that churn
+        # out permanently get compacted away in do_churn().
         self._wholenet = [ Node("node%d"%n,
                                 port=_randport(pfascistfriendly),
                                 evil=random.random() < pevil)
@@ -145,6 +178,18 @@ class Network(object):
                 node.kill()
                 nkilled += 1
 
+        # Compact the dead nodes out in place.  Nothing in the
+        # simulation resurrects a churned-out node, but new_consensus
+        # and updateRunning walk this whole list forever, so without
+        # this it grows without bound as the simulation runs.
+        keep = 0
+        wholenet = self._wholenet
+        for node in wholenet:
+            if not node._dead:
+                wholenet[keep] = node
+                keep += 1
+        del wholenet[keep:]
+
         # add nAdd new nodes.
         for n in xrange(self._total, self._total+nAdd):
             node = Node("node%d"%n,
@@ -187,7 +232,7 @@ class _NetworkDecorator(object):
 class FascistNetwork(_NetworkDecorator):
     """Network that blocks all connections except those to ports 80, 443"""
     def probe_node_is_up(self, node):
-        return (node.getPort() in [80,443] and
+        return (node.seemsDystopic() and
                 self._network.probe_node_is_up(node))
 
 class EvilFilteringNetwork(_NetworkDecorator):